@@ -1,18 +1,20 @@
 #!/usr/bin/env python3
 import os
+import re
+import time
+import threading
 
+from copy import copy
 from html import escape
 from functools import wraps
+from functools import lru_cache
+from collections import namedtuple
+from collections import OrderedDict
+from types import FunctionType
 from contextlib import contextmanager
 
-from docopt import docopt
-from jinja2 import Environment
-from jinja2 import FileSystemLoader
-
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import get_formatter_by_name
-from pygments.util import ClassNotFound
+# docopt, jinja2 and pygments are imported where they are used, so that
+# `import azf` stays cheap for callers that only need `parse`.
 
 
 class EndOfFile(Exception):
@@ -53,77 +55,114 @@ class StringNavigator(object):
                     return out, char
 
 
-def parse(source, command_character="ⵣ"):
-    source = StringNavigator(source)
-    eol_count = 1
-    while True:
-        text, why = source.takewhile(lambda char: char not in (command_character, '\n'))
-
-        if why is EndOfFile and text:
-            yield dict(kind='text', value=text)
-            raise StopIteration
-
-        elif why is EndOfFile:
-            raise StopIteration
-
-        elif why == '\n' and text:
-            yield dict(kind='text', value=text)
-            yield dict(kind='eol')
-
-        elif why == '\n':
-            yield dict(kind='eol')
+def parse(source, command_character="ⵣ", max_nesting=None):
+    """Yield the tokens of `source`.
+
+    Arguments are parsed in the same single pass over `source` as the
+    rest of the document so that parsing time is linear in the size of
+    the input whatever the nesting. `max_nesting` limits how deep
+    arguments can be nested."""
+    command_character = re.escape(command_character)
+    specials = re.compile('[%s\n{}]' % command_character)
+    terminators = re.compile('[%s\n {}]' % command_character)
+    # arguments being parsed, innermost last, each one is
+    # [command name, arguments, tokens of the current argument, curly braces depth]
+    stack = list()
+    tokens = list()  # complete top level tokens
+    text = ''
+    position = 0
+
+    def close():
+        # the current argument is complete, and so is its command unless
+        # another argument follows
+        nonlocal position
+        frame = stack[-1]
+        frame[1].append(frame[2])
+        if source.startswith('{', position):
+            position += 1
+            frame[2] = list()
+            frame[3] = 0
+        else:
+            stack.pop()
+            out = stack[-1][2] if stack else tokens
+            out.append(dict(kind='command', value=frame[0], arguments=frame[1]))
 
-        elif why == command_character:
+    while True:
+        out = stack[-1][2] if stack else tokens
+        match = specials.search(source, position)
+        if match is None:
+            text += source[position:]
             if text:
-                yield dict(kind='text', value=text)
-
-            name, why = source.takewhile(lambda char: char not in ('{', ' ', '\n', command_character))
-            if why in ('\n', ' ', command_character, EndOfFile):
-                yield dict(kind='command', value=name, arguments=tuple())
-                if why is EndOfFile:
-                    raise StopIteration
-                else:
-                    # avoid consuming the next value's first char
-                    source.back()
-                    continue
-
-            else:  # met a curly brace, parse arguments
-                nesting_level = 1
-                arguments = list()
-                argument = ''
+                out.append(dict(kind='text', value=text))
+            # end of file, close arguments left open
+            while stack:
+                position = len(source)
+                close()
+            yield from tokens
+            return
+
+        index = match.start()
+        char = source[index]
+        text += source[position:index]
+        position = index + 1
+
+        if char in '{}':
+            if not stack:
+                # curly braces are text outside arguments
+                text += char
+            elif char == '{':
+                text += char
+                stack[-1][3] += 1
+            elif stack[-1][3] > 0:
+                text += char
+                stack[-1][3] -= 1
+            else:
+                if text:
+                    out.append(dict(kind='text', value=text))
+                    text = ''
+                close()
+        else:
+            if text:
+                out.append(dict(kind='text', value=text))
+                text = ''
+            if char == '\n':
+                out.append(dict(kind='eol'))
+            else:  # command character, parse the command name
+                name = ''
                 while True:
-                    # parse one argument
-                    content, why = source.takewhile(lambda char: char not in ('{', '}'))
-                    if why is '{':
-                        nesting_level += 1
-                        argument += content + why
-                    elif why == '}' and (nesting_level - 1) > 0:
-                        nesting_level -= 1
-                        argument += content + why
-                    else:
-                        argument += content
-                        argument = list(parse(argument, command_character))
-                        arguments.append(argument)
-                        try:
-                            next = source.next()
-                        except EndOfFile:
-                            yield dict(kind='command', value=name, arguments=arguments)
-                            raise StopIteration
-                        if next == '{':
-                            nesting_level = 1
-                            argument = ''
-                            # there is at least one more arguments to parse
-                            continue
-                        else:
-                            # End of command, there is more text to parse,
-                            # avoid consuming the next value's first char.
-                            source.back()
-                            yield dict(kind='command', value=name, arguments=arguments)
-                            break
+                    match = terminators.search(source, position)
+                    if match is None:
+                        name += source[position:]
+                        position = len(source)
+                        char = None
+                        break
+                    index = match.start()
+                    char = source[index]
+                    name += source[position:index]
+                    position = index
+                    if char != '}':
+                        break
+                    elif not stack:
+                        name += char
+                        position += 1
+                    elif stack[-1][3] > 0:
+                        name += char
+                        position += 1
+                        stack[-1][3] -= 1
+                    else:  # end of the argument the command is in
+                        break
+                if char == '{':
+                    if max_nesting is not None and len(stack) >= max_nesting:
+                        msg = 'Arguments are nested deeper than %s levels' % max_nesting
+                        raise AzoufzoufException(msg)
+                    stack.append([name, list(), list(), 0])
+                    position += 1
+                else:
+                    out.append(dict(kind='command', value=name, arguments=tuple()))
 
-        else:
-            msg = 'Not sure what happened, you should ask a hearing to the king...'
-            raise AzoufzoufException(mg)
+        if tokens:
+            yield from tokens
+            del tokens[:]
 
 
 def is_paragraph(func):
@@ -132,9 +171,65 @@ def is_paragraph(func):
     return func
 
 
+def not_command(func):
+    """Declare a public method of a renderer that is not a command"""
+    func.is_command = False
+    return func
+
+
 NOMODE, PARAGRAPH, INLINE, VERBATIM = range(4)
 
 
+class Command(namedtuple('Command', ('name', 'handler', 'paragraph', 'minimum', 'maximum'))):
+    """A command of a renderer. `handler` is called with the renderer and
+    between `minimum` and `maximum` arguments, None means no maximum."""
+
+    @classmethod
+    def make(cls, name, handler, paragraph=None, bound=None):
+        """`bound` is the command bound to a renderer, when `handler` is
+        not a function taking the renderer first it gives the arity."""
+        from inspect import Parameter
+        from inspect import signature
+
+        if paragraph is None:
+            paragraph = getattr(handler, 'is_paragraph', False)
+        if bound is None:
+            # the first parameter is the renderer
+            parameters = list(signature(handler).parameters.values())[1:]
+        else:
+            parameters = list(signature(bound).parameters.values())
+        positional = [
+            parameter for parameter in parameters
+            if parameter.kind in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD)
+        ]
+        minimum = len([parameter for parameter in positional if parameter.default is Parameter.empty])
+        if any(parameter.kind == Parameter.VAR_POSITIONAL for parameter in parameters):
+            maximum = None
+        else:
+            maximum = len(positional)
+        return cls(name, handler, paragraph, minimum, maximum)
+
+    def check(self, arguments):
+        count = len(arguments)
+        if count < self.minimum or (self.maximum is not None and count > self.maximum):
+            if self.maximum is None:
+                expected = 'at least %s' % self.minimum
+            elif self.minimum == self.maximum:
+                expected = str(self.minimum)
+            else:
+                expected = '%s to %s' % (self.minimum, self.maximum)
+            msg = 'Command %s takes %s arguments, got %s' % (self.name, expected, count)
+            raise AzoufzoufException(msg)
+
+
+def _method(name):
+    # handler of a command that is not a plain function, like a
+    # staticmethod or a callable object, looked up like a method
+    def handler(self, *arguments):
+        return getattr(self, name)(*arguments)
+    return handler
+
+
 def compose(*funcs):
     def composed(*args):
         out = funcs[0](*args)
@@ -144,32 +239,536 @@ def compose(*funcs):
     return composed
 
 
-pygments_html_formatter = get_formatter_by_name('html')
+@lru_cache(maxsize=None)
+def _formatter(name='html', **options):
+    from pygments.formatters import get_formatter_by_name
+    return get_formatter_by_name(name, **options)
+
+
+@lru_cache(maxsize=None)
+def _lexer(lang):
+    """pygments lexer for `lang` or None"""
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+
+    try:
+        return get_lexer_by_name(lang)
+    except ClassNotFound:
+        return None
+
+
+def __getattr__(name):
+    # keep `azf.pygments_html_formatter` around without paying for
+    # pygments at import time
+    if name == 'pygments_html_formatter':
+        return _formatter('html')
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+_MISSING = object()
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    else:
+        return (stat.st_mtime_ns, stat.st_size)
+
+
+class _Context(dict):
+    """dict that remembers the keys that were looked up and set"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = set()
+        self.writes = set()
+
+    def __setitem__(self, key, value):
+        self.writes.add(key)
+        super().__setitem__(key, value)
+
+    def setdefault(self, key, default=None):
+        self.writes.add(key)
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        self.writes.update(other)
+        super().update(other)
+
+    def __getitem__(self, key):
+        self.reads.add(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.reads.add(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self.reads.add(key)
+        return super().get(key, default)
+
+
+def _render_chunk(render, tokens, context, basepath, deadline):
+    """Render `tokens`, returns the output and the context keys set by
+    the commands"""
+    output = render._generate(tokens, context, basepath, tuple(), deadline)
+    output['body'] = str(output['body'])
+    return dict(output), output.writes - {'body'}
+
+
+def _walk(tokens):
+    """Yield `tokens` and the tokens of the arguments of their commands,
+    in the order of the document"""
+    stack = [iter(tokens)]
+    while stack:
+        for token in stack[-1]:
+            yield token
+            if token['kind'] == 'command':
+                stack.append(iter([token for argument in token['arguments'] for token in argument]))
+                break
+        else:
+            stack.pop()
+
+
+def _commands(tokens):
+    """Yield the command tokens of `tokens` and of their arguments"""
+    return (token for token in _walk(tokens) if token['kind'] == 'command')
+
+
+class Cache:
+    """Thread safe mapping that only keeps the `size` most recently used
+    items. Renderers keep file contents and highlighted code in it."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return dict(size=self.size, _items=self._items)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def keys(self):
+        with self._lock:
+            return list(self._items)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._items[key]
+            self._items.move_to_end(key)
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self._set(key, default)
+                return default
+            else:
+                self._items.move_to_end(key)
+                return value
+
+    def _set(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class Body:
+    """Lazily rendered html of a document.
+
+    Iterating consumes the rendering, chunks are buffered up to `size`
+    characters. It can only be consumed once."""
+
+    def __init__(self, chunks, size=8192):
+        self._chunks = chunks
+        self._size = size
+
+    def __iter__(self):
+        buffer = []
+        length = 0
+        for chunk in self._chunks:
+            buffer.append(chunk)
+            length += len(chunk)
+            if length >= self._size:
+                yield ''.join(buffer)
+                buffer = []
+                length = 0
+        if buffer:
+            yield ''.join(buffer)
+
+    def __str__(self):
+        return ''.join(self)
+
+    __html__ = __str__
 
 
 class HTML:
 
-    is_paragraph = is_paragraph
+    is_paragraph = not_command(is_paragraph)
+
+    # Limits for untrusted input, None means unlimited. Override them in
+    # a subclass, going over a limit raises AzoufzoufException.
+    max_source_size = None  # characters in a document or required file
+    max_nesting = None  # depth of nested command arguments
+    max_require_depth = None  # depth of nested `require`
+    max_output_size = None  # characters in a rendered body
+    time_budget = None  # seconds to render a document, requires included
+    confine_paths = False  # refuse files outside of the document basepath
+
+    # Processes rendering the top level paragraphs of a document in
+    # parallel, in chunks of at least `chunk_size` tokens. Chunks are
+    # rendered in order up to the last one with a command listed in
+    # `_sets_context`. Other commands setting context are found while
+    # rendering, the chunks after them are rendered again in order.
+    workers = None
+    chunk_size = 1000
+    _sets_context = frozenset(('title',))
+
+    # outputs of a required file memoized for different context values
+    require_memo_size = 16
+
+    _paragraph = ('<p>', '</p>')
+    _files = None
+    _root = None
+
+    def __init__(self, cache=None, references=None):
+        # file contents and highlighted code, can be shared by renderers
+        # of any class, rendered outputs are keyed by the class
+        self._cache = Cache() if cache is None else cache
+        # urls `href` looks up when they are not in the context
+        self.references = dict() if references is None else references
 
     @classmethod
     def render(cls, source, basepath=None, **context):
         """render a azf string to html"""
-        tokens = parse(source)
         _render = cls()
+        tokens = _render._parse(source)
         output = _render(tokens, context, basepath)
         return output
 
+    @classmethod
+    def stream(cls, source, basepath=None, **context):
+        """render a azf string to html lazily, `body` is a `Body`"""
+        _render = cls()
+        tokens = _render._parse(source)
+        output = _render.generate(tokens, context, basepath)
+        return output
+
+    @classmethod
+    def render_many(cls, sources, template=None, context=None, basepath=None,
+                    paths=tuple(), filters=None, workers=None, ordered=True):
+        """Render several documents with a single setup.
+
+        `sources` are azf strings, relative to `basepath`, or os.PathLike
+        paths of azf files. The renderer caches and, when `template` is
+        set, the jinja environment looking up templates in `paths` are
+        shared by the whole batch. Yields `(source, output)` where output
+        is the rendered template or the context like `HTML.render`.
+
+        With `workers` the documents are rendered in a thread pool, in
+        order unless `ordered` is False."""
+        context = dict() if context is None else context
+        _render = cls()
+        if template is None:
+            jinja = None
+        else:
+            jinja = Jinja(*paths, **(filters or dict()))
+
+        def one(source):
+            if isinstance(source, os.PathLike):
+                path = os.fspath(source)
+                text = _render._read(path)
+                base = os.path.dirname(path)
+            else:
+                text = source
+                base = basepath
+            output = _render(_render._parse(text), context, base)
+            if jinja is not None:
+                output = jinja(template, output)
+            return source, output
+
+        if not workers:
+            yield from map(one, sources)
+        else:
+            from concurrent.futures import as_completed
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(workers) as executor:
+                if ordered:
+                    yield from executor.map(one, sources)
+                else:
+                    futures = [executor.submit(one, source) for source in sources]
+                    for future in as_completed(futures):
+                        yield future.result()
+
+    @classmethod
+    def commands(cls):
+        """Mapping of the names of the commands of this class to `Command`,
+        built on first use.
+
+        Commands are the public methods, except classmethods, properties
+        and methods declared `not_command`. Staticmethods, partialmethods
+        and callable objects are commands too. Set a command to None to
+        remove it in a subclass."""
+        try:
+            return cls.__dict__['_commands']
+        except KeyError:
+            pass
+        out = dict()
+        # overrides of a method declared `not_command` are not commands
+        api = set()
+        # descriptors are bound to an instance to read their signature
+        instance = cls.__new__(cls)
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                if name.startswith('_') or name in api:
+                    continue
+                if value is None:
+                    out.pop(name, None)
+                    continue
+                if not getattr(value, 'is_command', True):
+                    api.add(name)
+                    continue
+                if isinstance(value, FunctionType):
+                    out[name] = Command.make(name, value)
+                    continue
+                if isinstance(value, (classmethod, property)):
+                    bound = None
+                elif hasattr(type(value), '__get__'):
+                    bound = value.__get__(instance, cls)
+                else:
+                    bound = value
+                if callable(bound) and getattr(bound, 'is_command', True):
+                    paragraph = getattr(value, 'is_paragraph', getattr(bound, 'is_paragraph', False))
+                    out[name] = Command.make(name, _method(name), paragraph, bound)
+                elif name in out:
+                    msg = '%s.%s overrides a command with %r that can not be called'
+                    raise AzoufzoufException(msg % (klass.__name__, name, value))
+            for name, (handler, paragraph) in vars(klass).get('_registered', dict()).items():
+                out[name] = Command.make(name, handler, paragraph)
+        cls._commands = out
+        return out
+
+    @classmethod
+    def register(cls, name, handler=None, paragraph=None):
+        """Add `handler` as the command `name` of this class and its
+        subclasses. `handler` takes the renderer then the arguments of the
+        command. `paragraph` defaults to the `is_paragraph` flag of the
+        handler. Without `handler`, returns a decorator."""
+        if handler is None:
+            return lambda handler: cls.register(name, handler, paragraph) or handler
+        if '_registered' not in cls.__dict__:
+            cls._registered = dict()
+        cls._registered[name] = (handler, paragraph)
+        # commands are built again on next use
+        classes = [cls]
+        while classes:
+            klass = classes.pop()
+            if '_commands' in klass.__dict__:
+                del klass._commands
+            classes.extend(klass.__subclasses__())
+
+    @classmethod
+    def validate(cls, source):
+        """Parse `source` and check that its commands exist and get the
+        right number of arguments, without rendering anything. Returns the
+        tokens."""
+        tokens = list(cls()._parse(source))
+        for token in _commands(tokens):
+            cls._command(token)
+        return tokens
+
+    @classmethod
+    def _command(cls, token):
+        try:
+            command = cls.commands()[token['value']]
+        except KeyError:
+            raise AzoufzoufException('Unknown command: %s' % token['value'])
+        command.check(token['arguments'])
+        return command
+
+    def _parse(self, source):
+        if self.max_source_size is not None and len(source) > self.max_source_size:
+            msg = 'Document is bigger than %s characters' % self.max_source_size
+            raise AzoufzoufException(msg)
+        return parse(source, max_nesting=self.max_nesting)
+
     def __call__(self, source, context, basepath):
-        self._context = dict(**context)
-        self._basepath = basepath
+        if self.workers:
+            return self._parallel(source, context, basepath)
+        output = self.generate(source, context, basepath)
+        output['body'] = str(output['body'])
+        return output
 
-        self._mode = NOMODE   # add link
-        self._space_count = 0
+    def _chunks(self, tokens):
+        """Split top level tokens after blank lines, where no paragraph is
+        open, in chunks of at least `chunk_size` tokens"""
+        chunk = list()
+        eol_count = 0
+        for token in tokens:
+            if token['kind'] == 'eol':
+                eol_count += 1
+            else:
+                if eol_count >= 2 and len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = list()
+                eol_count = 0
+            chunk.append(token)
+        if chunk:
+            yield chunk
 
-        body = ''.join(self.to_html(source))
-        self._context['body'] = body
+    def _parallel(self, source, context, basepath):
+        from itertools import repeat
+        from concurrent.futures import ProcessPoolExecutor
 
-        return self._context
+        if self.time_budget is None:
+            deadline = None
+        else:
+            deadline = time.monotonic() + self.time_budget
+        chunks = list(self._chunks(source))
+        # Commands like `title` set context that any later command may
+        # read. Chunks up to the last one setting context are rendered in
+        # order, each with the context of the previous ones, the others in
+        # parallel with the complete context.
+        serial = 0
+        for index, chunk in enumerate(chunks):
+            if any(token['value'] in self._sets_context for token in _commands(chunk)):
+                serial = index + 1
+
+        output = dict(**context)
+        bodies = list()
+        size = 0
+
+        def collect(chunk):
+            nonlocal size
+            body = chunk.pop('body')
+            size += len(body)
+            if self.max_output_size is not None and size > self.max_output_size:
+                msg = 'Output is bigger than %s characters' % self.max_output_size
+                raise AzoufzoufException(msg)
+            if deadline is not None and time.monotonic() > deadline:
+                msg = 'Rendering took more than %s seconds' % self.time_budget
+                raise AzoufzoufException(msg)
+            bodies.append(body)
+            output.update(chunk)
+
+        def serially(chunks):
+            for chunk in chunks:
+                collect(_render_chunk(self, chunk, output, basepath, deadline)[0])
+
+        serially(chunks[:serial])
+        rest = chunks[serial:]
+        if rest:
+            worker = copy(self)
+            worker._cache = Cache()
+            with ProcessPoolExecutor(self.workers) as executor:
+                rendered = executor.map(
+                    _render_chunk,
+                    repeat(worker),
+                    rest,
+                    repeat(dict(output)),
+                    repeat(basepath),
+                    repeat(deadline),
+                )
+                try:
+                    for index, (chunk, writes) in enumerate(rendered):
+                        collect(chunk)
+                        if writes:
+                            # the next chunks were rendered without this context
+                            executor.shutdown(cancel_futures=True)
+                            serially(rest[index + 1:])
+                            break
+                except BaseException:
+                    # do not wait for the chunks that are queued
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+        output['body'] = ''.join(bodies)
+        return output
+
+    @not_command
+    def generate(self, source, context, basepath):
+        """Same as calling the renderer except `body` is a `Body`. Context
+        set by commands, like `title`, is only known once the body is
+        consumed."""
+        if self.time_budget is None:
+            deadline = None
+        else:
+            deadline = time.monotonic() + self.time_budget
+        return self._generate(source, context, basepath, tuple(), deadline)
+
+    def _generate(self, source, context, basepath, requiring, deadline):
+        _render = self._state(context, basepath, requiring, deadline)
+        body = _render._limit_recursion(_render.to_html(source))
+        if self.max_output_size is not None:
+            body = _render._limit_output(body)
+        _render._context['body'] = Body(body)
+
+        return _render._context
+
+    def _state(self, context, basepath, requiring, deadline):
+        # The state of a rendering lives on a shallow copy of the renderer
+        # that shares its configuration and caches, so that a renderer can
+        # be used by several threads, or again while it renders.
+        _render = copy(self)
+        _render._context = _Context(context)
+        _render._basepath = basepath
+        # required files are confined to the basepath of the document
+        _render._root = self._root if requiring else basepath
+        _render._requiring = requiring  # paths of the required files being rendered
+        _render._deadline = deadline
+        _render._files = dict()  # path -> (mtime, size) of the files read
+        _render._links = set()  # references looked up
+
+        _render._mode = NOMODE   # add link
+        _render._space_count = 0
+
+        return _render
+
+    def _limit_recursion(self, chunks):
+        # `max_nesting` bounds the parser, rendering nested arguments
+        # recurses and may still hit the interpreter recursion limit.
+        try:
+            yield from chunks
+        except RecursionError:
+            raise AzoufzoufException('Document is nested too deep to render') from None
+
+    def _limit_output(self, chunks):
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            if size > self.max_output_size:
+                msg = 'Output is bigger than %s characters' % self.max_output_size
+                raise AzoufzoufException(msg)
+            yield chunk
 
     @contextmanager
     def _inline(self):
@@ -185,24 +784,23 @@ class HTML:
         yield
         self._mode = previous
 
+    @not_command
     def to_html(self, tokens):
         """Takes the output of azf.parse and yields html strings"""
         eol_count = 0
         for token in tokens:
+            if self._deadline is not None and time.monotonic() > self._deadline:
+                msg = 'Rendering took more than %s seconds' % self.time_budget
+                raise AzoufzoufException(msg)
             kind = token['kind']
             if kind == 'command':
                 eol_count = 0
-                command = token['value']
-                try:
-                    method = getattr(self, command)
-                except AttributeError:
-                    raise AzoufzoufException('Unknown command: %s' % command)
+                command = self._command(token)
+                if command.paragraph:
+                    with self._inline():
+                        yield from self._emit(command.handler(self, *token['arguments']))
                 else:
-                    if getattr(method, 'is_paragraph', False):
-                        with self._inline():
-                            yield from self._emit(method(*token['arguments']))
-                    else:
-                        yield from self._emit(method(*token['arguments']))
+                    yield from self._emit(command.handler(self, *token['arguments']))
             elif kind == 'text':
                 eol_count = 0
                 yield from self._emit(token['value'])
@@ -224,7 +822,7 @@ class HTML:
         elif value == '\n':
             self._space_count = 0
             if self._mode == PARAGRAPH:
-                yield '</p>'
+                yield self._paragraph[1]
                 self._mode = NOMODE
             elif self._mode == VERBATIM:
                 yield '\n'
@@ -234,17 +832,58 @@ class HTML:
             self._space_count = 0
             if self._mode == NOMODE:
                 self._mode = PARAGRAPH
-                yield '<p>'
+                yield self._paragraph[0]
             yield from value
 
 
+    def _reference(self, url, default):
+        self._links.add(url)
+        return self.references.get(url, default)
+
+    def _path(self, filepath):
+        path = os.path.join(self._basepath, filepath)
+        if self.confine_paths:
+            root = os.path.realpath(self._root)
+            if os.path.commonpath((root, os.path.realpath(path))) != root:
+                raise AzoufzoufException('File is outside of %s: %s' % (self._root, filepath))
+        return path
+
+    def _read(self, path):
+        stat = os.stat(path)
+        if self._files is not None:
+            self._files[path] = (stat.st_mtime_ns, stat.st_size)
+        key = ('file', path, stat.st_mtime_ns, stat.st_size)
+        try:
+            out = self._cache[key]
+        except KeyError:
+            # Devices and pipes have no size, read at most one character
+            # more than the limit to know if the file is bigger.
+            size = -1 if self.max_source_size is None else self.max_source_size + 1
+            with open(path) as f:
+                out = f.read(size)
+            if size == -1 or len(out) < size:
+                self._cache[key] = out
+        if self.max_source_size is not None and len(out) > self.max_source_size:
+            msg = 'File is bigger than %s characters: %s' % (self.max_source_size, path)
+            raise AzoufzoufException(msg)
+        return out
+
     def _highlight(self, lang, code):
+        key = ('highlight', type(self), lang, code)
         try:
-            lexer = get_lexer_by_name(lang)
-        except ClassNotFound:
-            return '<pre>%s</pre>' % code
-        else:
-            return highlight(code, lexer, pygments_html_formatter)
+            return self._cache[key]
+        except KeyError:
+            lexer = _lexer(lang)
+            if lexer is None:
+                out = '<pre>%s</pre>' % code
+            else:
+                out = self._format(lexer, code)
+            self._cache[key] = out
+            return out
+
+    def _format(self, lexer, code):
+        from pygments import highlight
+        return highlight(code, lexer, _formatter('html'))
 
     # start of command definition
 
@@ -264,7 +903,7 @@ class HTML:
             yield from self.to_html(value)
         yield '</%s>' % tag
 
-    factory = lambda tag: is_paragraph(lambda self, value: self._section(tag, value))
+    factory = not_command(lambda tag: is_paragraph(lambda self, value: self._section(tag, value)))
 
     section, subsection, subsubsection, subsubsubsection, subsubsubsubsection = map(
         factory,
@@ -296,13 +935,18 @@ class HTML:
         try:
             url = self._context[url]
         except KeyError:
-            pass
+            url = self._reference(url, url)
 
         if klass:
             yield '<a href="%s" class="%s">%s</a>' % (url, klass, text)
         else:
             yield '<a href="%s">%s</a>' % (url, text)
 
+    def anchor(self, name):
+        with self._inline():
+            name = ''.join(self.to_html(name))
+        yield '<a id="%s"></a>' % name
+
     def image(self, url, text):
         with self._inline():
             url, text = map(compose(self.to_html, ''.join), (url, text))
@@ -323,8 +967,7 @@ class HTML:
         with self._inline():
             filepath = ''.join(self.to_html(value))
 
-        with open(os.path.join(self._basepath, filepath)) as f:
-            code = f.read()
+        code = self._read(self._path(filepath))
         _, lang = os.path.splitext(filepath)
         lang = lang[1:]
         code = self._highlight(lang, code)
@@ -335,11 +978,56 @@ class HTML:
     def require(self, filepath):
         with self._inline():
             filepath = ''.join(self.to_html(filepath))
-        fullpath = os.path.join(self._basepath, filepath)
+        fullpath = self._path(filepath)
         basepath = os.path.dirname(fullpath)
-        with open(fullpath) as f:
-            output = self.render(f.read(), basepath, **self._context)
-        body = output['body']
+        if os.path.realpath(fullpath) in self._requiring:
+            raise AzoufzoufException('Require cycle: %s' % filepath)
+        depth = len(self._requiring)
+        if self.max_require_depth is not None and depth >= self.max_require_depth:
+            msg = 'Requires are nested deeper than %s levels' % self.max_require_depth
+            raise AzoufzoufException(msg)
+        # The output of a required file is memoized with the values of the
+        # context keys and references it read, and the files it depends
+        # on. They are read through self so that they are dependencies of
+        # the caller too.
+        stat = os.stat(fullpath)
+        key = ('require', type(self), os.path.realpath(fullpath), stat.st_mtime_ns, stat.st_size)
+        memo = self._cache.setdefault(key, Cache(self.require_memo_size))
+        for names, links in dict.fromkeys((names, links) for names, links, _ in memo.keys()):
+            values = (
+                tuple(self._context.get(name, _MISSING) for name in names),
+                tuple(self._reference(link, _MISSING) for link in links),
+            )
+            try:
+                files, body = memo[(names, links, values)]
+            except (KeyError, TypeError):  # TypeError: unhashable values
+                continue
+            if all(_stat(path) == value for path, value in files.items()):
+                self._files.update(files)
+                return body
+
+        source = self._read(fullpath)
+        _render = self._state(
+            self._context,
+            basepath,
+            self._requiring + (os.path.realpath(fullpath),),
+            self._deadline,
+        )
+        body = _render.to_html(self._parse(source))
+        if self.max_output_size is not None:
+            body = _render._limit_output(body)
+        body = ''.join(body)
+        self._files.update(_render._files)
+        names = tuple(sorted(_render._context.reads, key=str))
+        links = tuple(sorted(_render._links))
+        values = (
+            tuple(self._context.get(name, _MISSING) for name in names),
+            tuple(self._reference(link, _MISSING) for link in links),
+        )
+        try:
+            memo[(names, links, values)] = (_render._files, body)
+        except TypeError:
+            pass  # unhashable values are not memoized
         return body
 
     def context(self, value):
@@ -357,9 +1045,172 @@ class HTML:
         yield code
 
 
+@lru_cache(maxsize=None)
+def _is_styled(style, ttype):
+    from pygments.styles import get_style_by_name
+    definition = get_style_by_name(style).style_for_token(ttype)
+    return any(definition.values())
+
+
+class CompactHTML(HTML):
+    """HTML renderer with terse markup for code blocks.
+
+    Highlighted code is wrapped in a single `<pre class="hl">` and only
+    tokens that `style` gives a look get a `<span>`. The rules live in
+    one stylesheet per build, see `CompactHTML.stylesheet`."""
+
+    style = 'default'
+
+    @classmethod
+    def stylesheet(cls):
+        """css for the code blocks rendered by this class"""
+        return _formatter('html', style=cls.style).get_style_defs('.hl')
+
+    def _format(self, lexer, code):
+        from pygments import format
+        from pygments.token import Text
+        from pygments.token import Whitespace
+
+        # whitespace and unstyled tokens are merged into plain text,
+        # spans that would not change the look are not emitted
+        tokens = (
+            (Text if ttype in Whitespace or not _is_styled(self.style, ttype) else ttype, value)
+            for ttype, value in lexer.get_tokens(code)
+        )
+        formatter = _formatter('html', style=self.style, nowrap=True)
+        return '<pre class="hl">%s</pre>' % format(tokens, formatter)
+
+
+class Text(HTML):
+    """Render azf as plain text, e.g. for emails"""
+
+    _paragraph = ('', '\n\n')
+
+    @is_paragraph
+    def title(self, value):
+        with self._inline():
+            title = ''.join(self.to_html(value))
+        self._context['title'] = title
+        yield '%s\n%s\n\n' % (title, '=' * len(title))
+
+    def _section(self, tag, value):
+        with self._inline():
+            yield from self.to_html(value)
+        yield '\n\n'
+
+    @is_paragraph
+    def list(self, tokens):
+        self._space_count = 0
+        with self._inline():
+            yield from self.to_html(tokens)
+        yield '\n'
+
+    def item(self, value):
+        yield '- '
+        with self._inline():
+            yield from self.to_html(value)
+        yield '\n'
+
+    def href(self, url, text, klass=None):
+        with self._inline():
+            url, text = map(compose(self.to_html, ''.join), (url, text))
+        url = self._context.get(url, self._reference(url, url))
+        yield '%s <%s>' % (text, url)
+
+    def anchor(self, name):
+        yield from ()
+
+    def image(self, url, text):
+        with self._inline():
+            yield from self.to_html(text)
+
+    def code(self, text, klass=None):
+        with self._inline():
+            yield from self.to_html(text)
+
+    @is_paragraph
+    def include(self, value):
+        with self._inline():
+            filepath = ''.join(self.to_html(value))
+        yield self._read(self._path(filepath))
+        yield '\n'
+
+    @is_paragraph
+    def highlight(self, lang, code):
+        with self._verbatim():
+            yield from self.to_html(code)
+        yield '\n'
+
+
+class AST:
+    """Serialize the tokens of a document as json, like a renderer"""
+
+    def __call__(self, source, context, basepath):
+        output = self.generate(source, context, basepath)
+        output['body'] = str(output['body'])
+        return output
+
+    def generate(self, source, context, basepath):
+        context = dict(**context)
+        context['body'] = Body(self._dump(source))
+        return context
+
+    def _dump(self, tokens):
+        from json import dumps
+
+        yield '['
+        for index, token in enumerate(tokens):
+            if index:
+                yield ', '
+            yield dumps(token)
+        yield ']'
+
+
+def fanout(source, renderers, basepath=None, **context):
+    """Parse `source` once and render it with every renderer.
+
+    The tokens are handed to the renderers as they are parsed, the
+    renderers take turns so that only the tokens some renderer did not
+    consume yet are kept in memory. The source is parsed with the
+    smallest `max_source_size` and `max_nesting` of the renderers.
+    Returns the output of each renderer, like `HTML.render`, in the order
+    of `renderers`."""
+    from itertools import tee
+
+    def smallest(name):
+        limits = [getattr(renderer, name, None) for renderer in renderers]
+        limits = [limit for limit in limits if limit is not None]
+        return min(limits) if limits else None
+
+    max_source_size = smallest('max_source_size')
+    if max_source_size is not None and len(source) > max_source_size:
+        msg = 'Document is bigger than %s characters' % max_source_size
+        raise AzoufzoufException(msg)
+    tokens = tee(parse(source, max_nesting=smallest('max_nesting')), len(renderers))
+    outputs = [
+        renderer.generate(tokens, context, basepath)
+        for renderer, tokens in zip(renderers, tokens)
+    ]
+    bodies = [iter(output['body']) for output in outputs]
+    chunks = [list() for _ in renderers]
+    while any(body is not None for body in bodies):
+        for index, body in enumerate(bodies):
+            if body is not None:
+                try:
+                    chunks[index].append(next(body))
+                except StopIteration:
+                    bodies[index] = None
+    for output, chunks in zip(outputs, chunks):
+        output['body'] = ''.join(chunks)
+    return outputs
+
+
 class Jinja:
 
     def __init__(self, *paths, **filters):
+        from jinja2 import Environment
+        from jinja2 import FileSystemLoader
+
         paths = map(os.path.abspath, paths)
         self.environment = Environment(
             loader=FileSystemLoader(paths),
@@ -371,6 +1222,19 @@ class Jinja:
         out = template.render(**context)
         return out
 
+    def dump(self, template, context, destination, size=8192):
+        """Write the template output to `destination`, a filename or a
+        file object, as it is generated. Use
+        `{% for chunk in body %}{{ chunk }}{% endfor %}` in the template
+        to stream a `Body`."""
+        template = self.environment.get_template(template)
+        stream = template.stream(**context)
+        stream.enable_buffering(size)
+        if isinstance(destination, str):
+            stream.dump(destination, encoding='utf-8')
+        else:
+            stream.dump(destination)
+
     @classmethod
     def render(cls, template, *paths, filters=None, **context):
         if not filters:
@@ -379,30 +1243,486 @@ class Jinja:
         output = render(template, context)
         return output
 
+    @classmethod
+    def stream(cls, template, destination, *paths, filters=None, **context):
+        if not filters:
+            filters = dict()
+        render = cls(*paths, **filters)
+        render.dump(template, context, destination)
+
+
+def _text(tokens):
+    """Plain text of tokens, commands are replaced by their arguments"""
+    out = list()
+    for token in _walk(tokens):
+        if token['kind'] == 'text':
+            out.append(token['value'])
+        elif token['kind'] == 'eol':
+            out.append(' ')
+    return ''.join(out)
+
+
+class Index:
+    """Titles, section headings and anchors of the documents of a site.
+
+    Entries are collected from the tokens of the documents, which are not
+    rendered, and only for the documents that changed since the last
+    update. The index is saved as json between builds."""
+
+    SECTIONS = ('section', 'subsection', 'subsubsection', 'subsubsubsection', 'subsubsubsubsection')
+
+    def __init__(self, documents=None):
+        # document path -> dict(mtime, size, url, title, sections, anchors)
+        self.documents = dict() if documents is None else documents
+
+    @classmethod
+    def load(cls, path):
+        from json import load
+
+        try:
+            with open(path) as f:
+                return cls(load(f)['documents'])
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path):
+        from json import dump
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            dump(dict(documents=self.documents), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def collect(cls, tokens):
+        """Title, sections, anchors and required files found in `tokens`"""
+        out = dict(title=None, sections=list(), anchors=list(), requires=list())
+        for token in _commands(tokens):
+            if not token['arguments']:
+                continue
+            command = token['value']
+            if command == 'title':
+                out['title'] = _text(token['arguments'][0])
+            elif command in cls.SECTIONS:
+                out['sections'].append([command, _text(token['arguments'][0])])
+            elif command == 'anchor':
+                out['anchors'].append(_text(token['arguments'][0]))
+            elif command == 'require':
+                out['requires'].append(_text(token['arguments'][0]))
+        return out
+
+    def update(self, source, documents, url, parse=parse):
+        """Collect the `documents` found in `source` that changed, and forget
+        the others. `url` maps a document to its url, `parse` a file path to
+        its tokens. The urls of every document are updated. Returns the
+        documents that were collected."""
+        out = list()
+        for document in documents:
+            stat = os.stat(os.path.join(source, document))
+            entry = self.documents.get(document)
+            if entry and (entry['mtime'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+                # the url does not depend on the file, `url` may have changed
+                entry['url'] = url(document)
+                continue
+            entry = self.collect(parse(os.path.join(source, document)))
+            entry.update(mtime=stat.st_mtime_ns, size=stat.st_size, url=url(document))
+            self.documents[document] = entry
+            out.append(document)
+        for document in set(self.documents) - set(documents):
+            del self.documents[document]
+        return out
+
+    def groups(self):
+        """Documents that require one another, directly or through other
+        documents, are in the same group. Returns a mapping of documents to
+        the name of their group, its first document."""
+        parents = {document: document for document in self.documents}
+
+        def find(document):
+            while parents[document] != document:
+                parents[document] = parents[parents[document]]
+                document = parents[document]
+            return document
+
+        for document, entry in self.documents.items():
+            for filepath in entry.get('requires', list()):
+                filepath = os.path.normpath(os.path.join(os.path.dirname(document), filepath))
+                if filepath in parents:
+                    one, other = find(document), find(filepath)
+                    parents[max(one, other)] = min(one, other)
+        return {document: find(document) for document in parents}
+
+    @classmethod
+    def merge(cls, paths):
+        """Index with the documents of the indices saved at `paths`"""
+        out = cls()
+        for path in paths:
+            out.documents.update(cls.load(path).documents)
+        return out
+
+    def references(self):
+        """Urls of the documents and their anchors. A document is referenced
+        by its path without extension, an anchor as `document#anchor`."""
+        out = dict()
+        for document, entry in self.documents.items():
+            name = os.path.splitext(document)[0]
+            out[name] = entry['url']
+            for anchor in entry['anchors']:
+                out['%s#%s' % (name, anchor)] = '%s#%s' % (entry['url'], anchor)
+        return out
+
+
+class Report:
+    """Wall time and cpu time, or with `memory` peak memory, of each
+    document of a build. Tracing memory slows down every allocation, so
+    documents are not timed while it runs."""
 
-# if __name__ == '__main__':
-#     # main.py publish note <path>
-#     # main.py publish page <path>
-#     # main.py dung <path> [<output>] [--pretty-print=<indent>] [--ugly]
-#     # main.py render html <path>
-#     # main.py render jinja2 <template> <context> <output>
-#     # main.py build
-
-#     doc = """make.py.
-
-# Usage:
-#   make.py build --dev
-#   make.py build [<path>]
-#   make.py -h | --help
-#   make.py --version
-
-# Options:
-#   -h --help               Show this screen.
-#   --version               Show version.
-# """
-#     arguments = docopt(doc, version='15.01.29')
-#     print(arguments)
-#     main(arguments)
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.documents = list()
+
+    @contextmanager
+    def measure(self, name):
+        if self.memory:
+            with self._trace(name):
+                yield
+            return
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self.documents.append(dict(name=name, wall=wall, cpu=cpu))
+
+    @contextmanager
+    def _trace(self, name):
+        import tracemalloc
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            _, memory = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+            self.documents.append(dict(name=name, memory=memory))
+
+    def slowest(self, count=10):
+        documents = [document for document in self.documents if 'wall' in document]
+        return sorted(documents, key=lambda document: -document['wall'])[:count]
+
+    def heaviest(self, count=10):
+        documents = [document for document in self.documents if 'memory' in document]
+        return sorted(documents, key=lambda document: -document['memory'])[:count]
+
+    def format(self, count=10):
+        lines = list()
+        if self.memory:
+            lines.append('heaviest documents:')
+            for document in self.heaviest(count):
+                line = '  %10.2fKiB peak  %s' % (document['memory'] / 1024, document['name'])
+                lines.append(line)
+        else:
+            lines.append('slowest documents:')
+            for document in self.slowest(count):
+                line = '  %10.2fms wall %10.2fms cpu  %s' % (
+                    document['wall'] * 1000, document['cpu'] * 1000, document['name']
+                )
+                lines.append(line)
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Write the measures as json, sorted by document name"""
+        from json import dump
+
+        documents = sorted(self.documents, key=lambda document: document['name'])
+        with open(path, 'w') as f:
+            dump(dict(documents=documents), f, indent=2)
+
+
+class Sink:
+    """Write files under `path`, skipping the ones whose content did not
+    change since the last build.
+
+    The sha256 of the files written is kept in a manifest. Files are
+    written to a temporary file then renamed over the previous version,
+    so readers never see a partial file. `written` and `skipped` count
+    the files since the sink was created."""
+
+    def __init__(self, path, manifest='.azf-manifest.json'):
+        from json import load
+
+        self.path = path
+        self.manifest_path = os.path.join(path, manifest)
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = load(f)
+        except FileNotFoundError:
+            self.manifest = dict()
+        self.written = 0
+        self.skipped = 0
+
+    def _unchanged(self, name, digest):
+        filepath = os.path.join(self.path, name)
+        return self.manifest.get(name) == digest and os.path.exists(filepath)
+
+    def write(self, name, content):
+        """Write `content`, a string or an iterable of strings, to `name`
+        relative to `path` unless it did not change. Returns True when the
+        file was written."""
+        from hashlib import sha256
+
+        filepath = os.path.join(self.path, name)
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+            digest = sha256(content).hexdigest()
+            if self._unchanged(name, digest):
+                self.skipped += 1
+                return False
+            content = (content,)
+        else:
+            content = (chunk.encode('utf-8') for chunk in content)
+            digest = None
+
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        temporary = '%s.%s.tmp' % (filepath, os.getpid())
+        try:
+            checksum = sha256()
+            with open(temporary, 'wb') as f:
+                for chunk in content:
+                    checksum.update(chunk)
+                    f.write(chunk)
+            if digest is None:
+                # streamed content is only known once written
+                digest = checksum.hexdigest()
+                if self._unchanged(name, digest):
+                    os.remove(temporary)
+                    self.skipped += 1
+                    return False
+            os.replace(temporary, filepath)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        self.manifest[name] = digest
+        self.written += 1
+        return True
+
+    def save(self):
+        from json import dump
+
+        os.makedirs(self.path, exist_ok=True)
+        temporary = '%s.%s.tmp' % (self.manifest_path, os.getpid())
+        with open(temporary, 'w') as f:
+            dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.manifest_path)
+
+
+class Build:
+    """Render the azf files found in `source` as html files in `output`.
+
+    Pages are rendered with `template` looked up in `paths` or written
+    as is. The context of every page has the `Index` of the site as
+    `index`, unless `context` has one, and the renderer gets its
+    references, so that `href` resolves links to other documents. Context
+    keys, like `index`, win over document names. Document urls start
+    with `baseurl`. Html files are written with a `Sink`, unchanged pages
+    are not written again. When the renderer has a `stylesheet`, like
+    `CompactHTML`, it is written as `Build.css` and its url is the
+    `stylesheet` of the context. With `profile`,
+    `Build.report` is a `Report` of the times of the documents, or of
+    their memory with `memory`.
+
+    `shard` is a pair `(index, count)`, starting at 1, to only build a
+    part of the documents. Documents that require one another are built
+    by the same shard. Shards write their own manifest and index, see
+    `Build.merge`."""
+
+    def __init__(self, source, output, template=None, paths=tuple(),
+                 context=None, renderer=HTML, profile=False, baseurl='/', shard=None,
+                 memory=False):
+        self.source = source
+        self.output = output
+        self.template = template
+        self.jinja = None if template is None else Jinja(*paths)
+        self.context = dict() if context is None else context
+        self.render = renderer()
+        self.report = Report(memory) if profile else None
+        self.baseurl = baseurl
+        self.shard = shard
+        self.index = Index.load(self.index_path())
+        self.sink = Sink(output, self._filename('.azf-manifest', shard))
+
+    css = 'highlight.css'
+
+    @staticmethod
+    def _filename(name, shard):
+        if shard is None:
+            return name + '.json'
+        index, count = shard
+        return '%s.%s-%s.json' % (name, index, count)
+
+    def index_path(self):
+        return os.path.join(self.output, self._filename('.azf-index', self.shard))
+
+    @classmethod
+    def merge(cls, output, count):
+        """Combine the manifests and indices written by the `count` shards
+        of a build in `output`. Files of shards of a build with another
+        count are ignored, the shard files are kept for the next build."""
+        from json import load
+
+        manifests = list()
+        indices = list()
+        for index in range(1, count + 1):
+            shard = (index, count)
+            manifests.append(os.path.join(output, cls._filename('.azf-manifest', shard)))
+            indices.append(os.path.join(output, cls._filename('.azf-index', shard)))
+        for path in manifests + indices:
+            if not os.path.exists(path):
+                raise AzoufzoufException('Shard file is missing: %s' % path)
+
+        sink = Sink(output)
+        for path in manifests:
+            with open(path) as f:
+                sink.manifest.update(load(f))
+        sink.save()
+        Index.merge(indices).save(os.path.join(output, '.azf-index.json'))
+
+    def _sharded(self, documents):
+        from zlib import crc32
+
+        index, count = self.shard
+        groups = self.index.groups()
+        out = list()
+        for document in documents:
+            group = groups[document].replace(os.sep, '/')
+            if crc32(group.encode('utf-8')) % count == index - 1:
+                out.append(document)
+        return out
+
+    def url(self, document):
+        return self.baseurl + os.path.splitext(document)[0].replace(os.sep, '/') + '.html'
+
+    def _tokens(self, path):
+        return list(self.render._parse(self.render._read(path)))
+
+    def documents(self):
+        """Paths of the azf files relative to `source`, sorted"""
+        out = list()
+        for root, directories, filenames in os.walk(self.source):
+            directories.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.azf'):
+                    path = os.path.join(root, filename)
+                    out.append(os.path.relpath(path, self.source))
+        return out
+
+    def __call__(self):
+        documents = self.documents()
+        self.index.update(self.source, documents, self.url, self._tokens)
+        self.index.save(self.index_path())
+        context = dict(self.context)
+        context.setdefault('index', self.index.documents)
+        self.render.references = self.index.references()
+        stylesheet = getattr(self.render, 'stylesheet', None)
+        if stylesheet is not None:
+            self.sink.write(self.css, stylesheet())
+            context.setdefault('stylesheet', self.baseurl + self.css)
+        if self.shard is not None:
+            documents = self._sharded(documents)
+        for document in documents:
+            if self.report is None:
+                self.build(document, context)
+            else:
+                with self.report.measure(document):
+                    self.build(document, context)
+        self.sink.save()
+        return self.report
+
+    def build(self, document, context):
+        """Render `document` and write its html file"""
+        path = os.path.join(self.source, document)
+        _render = self.render
+        tokens = _render._parse(_render._read(path))
+        output = _render(tokens, context, os.path.dirname(path))
+        if self.jinja is None:
+            html = output['body']
+        else:
+            html = self.jinja(self.template, output)
+        self.sink.write(os.path.splitext(document)[0] + '.html', html)
+
+
+def main(arguments):
+    if arguments['build']:
+        shard = arguments['--shard']
+        if shard is not None:
+            try:
+                shard = tuple(map(int, shard.split('/')))
+            except ValueError:
+                shard = ()
+            if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+                raise AzoufzoufException('--shard must be i/N with 1 <= i <= N')
+        build = Build(
+            arguments['<source>'],
+            arguments['<output>'],
+            arguments['--template'],
+            arguments['--templates'],
+            profile=arguments['--profile'] or arguments['--memory'] or bool(arguments['--report']),
+            shard=shard,
+            memory=arguments['--memory'],
+        )
+        report = build()
+        print('%s files written, %s unchanged' % (build.sink.written, build.sink.skipped))
+        if report is not None:
+            if arguments['--profile'] or not arguments['--report']:
+                print(report.format(int(arguments['--top'])))
+            if arguments['--report']:
+                report.dump(arguments['--report'])
+    elif arguments['merge']:
+        try:
+            count = int(arguments['--shards'])
+        except ValueError:
+            count = 0
+        if count < 1:
+            raise AzoufzoufException('--shards must be a number of shards, at least 1')
+        Build.merge(arguments['<output>'], count)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    doc = """azf.
+
+Usage:
+  azf.py build <source> <output> [--template=<name>] [--templates=<path>]... [--profile] [--memory] [--top=<n>] [--report=<json>] [--shard=<i/N>]
+  azf.py merge <output> --shards=<N>
+  azf.py -h | --help
+  azf.py --version
+
+Options:
+  -h --help               Show this screen.
+  --version               Show version.
+  --template=<name>       Jinja template of the pages.
+  --templates=<path>      Directory of the templates.
+  --profile               Print the slowest documents. Build again with --memory
+                          for the heaviest ones, memory is not measured while
+                          timing since tracing it slows rendering down.
+  --memory                Measure peak memory instead of time and print the
+                          heaviest documents, like --profile.
+  --top=<n>               Number of documents to print [default: 10].
+  --report=<json>         Write the time or memory of each document as json.
+  --shard=<i/N>           Only build the i-th of N parts of the documents, then
+                          use merge once every shard is done.
+  --shards=<N>            Number of shards of the build to merge.
+"""
+    arguments = docopt(doc, version='15.02.15')
+    main(arguments)
 
 
 # # TEST ################################################################################################
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Benchmarks for azf.
+
+Usage:
+  bench.py startup [--runs=<n>] [--budget=<ms>]
+
+Options:
+  --runs=<n>      Number of fresh interpreters to start [default: 20].
+  --budget=<ms>   Fail when the median `import azf` time exceeds it.
+"""
+import os
+import sys
+import subprocess
+from statistics import median
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _run(code):
+    env = dict(os.environ, PYTHONPATH=HERE)
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.STDOUT,
+        env=env,
+        universal_newlines=True,
+    )
+    return output
+
+
+def import_time(module):
+    """Cumulative import time of `module` in microseconds, in a fresh
+    interpreter, as reported by `-X importtime`"""
+    for line in _run('import %s' % module).splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and line.split('|')[-1].strip() == module:
+            return int(line.split('|')[1])
+    raise ValueError('%s was not imported' % module)
+
+
+def startup(runs=20, budget=None):
+    timings = sorted(import_time('azf') for _ in range(runs))
+    print('import azf: min %.2fms median %.2fms max %.2fms' % (
+        timings[0] / 1000, median(timings) / 1000, timings[-1] / 1000
+    ))
+    if budget is not None and median(timings) / 1000 > budget:
+        print('over budget of %.2fms' % budget)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    if arguments['startup']:
+        budget = arguments['--budget']
+        budget = float(budget) if budget else None
+        sys.exit(startup(int(arguments['--runs']), budget))
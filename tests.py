@@ -1,14 +1,30 @@
 import os
+import sys
+import subprocess
+from time import perf_counter
+from pathlib import Path
 from tempfile import mkdtemp
 from unittest import TestCase
 from shutil import rmtree
+from concurrent.futures import ThreadPoolExecutor
 
 from azf import parse
 from azf import HTML
+from azf import Body
+from azf import Cache
+from azf import CompactHTML
+from azf import Text
+from azf import AST
+from azf import fanout
 from azf import Jinja
+from azf import Build
+from azf import Index
+from azf import Sink
 from azf import AzoufzoufException
 
 from json import dumps
+from json import load
+from json import loads
 
 
 # lazy fixes to support new render signature
@@ -22,6 +38,22 @@ def jinja(template, context, *paths, **filters):
 
 
 
+class TestStartup(TestCase):
+
+    def test_import_is_lazy(self):
+        code = 'import sys, azf; print(" ".join(sorted(sys.modules)))'
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        modules = subprocess.check_output([sys.executable, '-c', code], env=env)
+        modules = modules.decode('utf-8').split()
+        for heavy in ('docopt', 'jinja2', 'pygments'):
+            self.assertNotIn(heavy, modules)
+
+    def test_pygments_html_formatter(self):
+        import azf
+        from pygments.formatters import HtmlFormatter
+        self.assertIsInstance(azf.pygments_html_formatter, HtmlFormatter)
+
+
 class TestParser(TestCase):
 
     def test_single_line(self):
@@ -546,6 +578,194 @@ blabla""", basepath=path)['body']
         rmtree(path)
 
 
+class TestCommands(TestCase):
+
+    def test_commands(self):
+        commands = HTML.commands()
+        self.assertIs(commands, HTML.commands())
+        self.assertEqual(commands['href'][2:], (False, 2, 3))
+        self.assertEqual(commands['section'][2:], (True, 1, 1))
+        for name in ('render', 'to_html', 'generate', 'factory', 'is_paragraph', '_highlight'):
+            self.assertNotIn(name, commands)
+        self.assertIn('stylesheet', dir(CompactHTML))
+        self.assertNotIn('stylesheet', CompactHTML.commands())
+
+    def test_arity(self):
+        with self.assertRaisesRegex(AzoufzoufException, 'href takes 2 to 3 arguments, got 1'):
+            render('ⵣhref{http://example.com}')
+        with self.assertRaisesRegex(AzoufzoufException, 'title takes 1 arguments, got 0'):
+            render('ⵣtitle')
+
+    def test_register(self):
+
+        class Custom(HTML):
+            pass
+
+        def shout(self, value):
+            with self._inline():
+                yield ''.join(self.to_html(value)).upper()
+
+        Custom.register('shout', shout)
+
+        @Custom.register('box', paragraph=True)
+        def box(self, *values):
+            yield '<div>%s</div>' % len(values)
+
+        output = Custom.render('ⵣshout{héllo} ⵣcode{x}\n\nⵣbox{a}{b}')['body']
+        self.assertEqual(output, '<p>HÉLLO <code>x</code></p><div>2</div>')
+        self.assertNotIn('shout', HTML.commands())
+
+        class Subclass(Custom):
+            pass
+
+        self.assertIn('shout', Subclass.commands())
+        Custom.register('late', lambda self: iter(('late',)))
+        self.assertEqual(Subclass.render('ⵣlate')['body'], '<p>late</p>')
+
+    def test_descriptors(self):
+        from functools import partialmethod
+
+        class Upper:
+
+            def __call__(self, value):
+                yield ''.join(token['value'] for token in value).upper()
+
+        class Custom(HTML):
+
+            def _wrap(self, tag, value):
+                with self._inline():
+                    yield '<%s>%s</%s>' % (tag, ''.join(self.to_html(value)), tag)
+
+            bold = partialmethod(_wrap, 'b')
+            code = staticmethod(lambda value: iter(('<tt/>',)))
+            shout = Upper()
+            anchor = None
+
+            def to_html(self, tokens):
+                yield from super().to_html(tokens)
+
+        commands = Custom.commands()
+        self.assertEqual(commands['bold'][2:], (False, 1, 1))
+        self.assertEqual(commands['shout'][2:], (False, 1, 1))
+        self.assertNotIn('anchor', commands)
+        self.assertNotIn('to_html', commands)
+        output = Custom.render('ⵣbold{a} ⵣcode{b} ⵣshout{c}')['body']
+        self.assertEqual(output, '<p><b>a</b> <tt/> C</p>')
+        with self.assertRaisesRegex(AzoufzoufException, 'Unknown command: anchor'):
+            Custom.render('ⵣanchor{a}')
+
+        class Broken(HTML):
+
+            code = 'code'
+
+        with self.assertRaisesRegex(AzoufzoufException, 'Broken.code overrides a command'):
+            Broken.commands()
+
+    def test_validate(self):
+        tokens = HTML.validate('ⵣsection{ⵣcode{reduce}}')
+        self.assertEqual(tokens, list(parse('ⵣsection{ⵣcode{reduce}}')))
+        # errors are found before the missing file is included
+        with self.assertRaisesRegex(AzoufzoufException, 'Unknown command: nope'):
+            HTML.validate('ⵣinclude{missing.py}\n\nⵣlist{ⵣitem{ⵣnope}}')
+        with self.assertRaisesRegex(AzoufzoufException, 'image takes 2 arguments, got 1'):
+            HTML.validate('ⵣinclude{missing.py}\n\nⵣsection{ⵣimage{a.png}}')
+
+
+class TestCompactHTML(TestCase):
+
+    def test_highlight(self):
+        code = """function troll() {
+    return undefined;
+}"""
+        expected = """<pre class="hl"><span class="kd">function</span> troll() {
+    <span class="k">return</span> <span class="kc">undefined</span>;
+}
+</pre>"""
+        output = CompactHTML.render("ⵣhighlight{javascript}{%s}" % code)['body']
+        self.assertEqual(output, expected)
+
+    def test_highlight_no_lexer(self):
+        output = CompactHTML.render("ⵣhighlight{nolexer}{x = 1}")['body']
+        self.assertEqual(output, '<pre>x = 1\n</pre>')
+
+    def test_stylesheet(self):
+        css = CompactHTML.stylesheet()
+        self.assertIn('.hl .kd {', css)
+        self.assertIn('.hl .kc {', css)
+
+
+class TestFanout(TestCase):
+
+    source = """ⵣtitle{Héllo}
+
+Some text with ⵣcode{code} and ⵣhref{home}{a link}
+over lines.
+
+ⵣsection{Part}
+
+ⵣlist{ⵣitem{one}ⵣitem{two}}
+
+ⵣhighlight{nolexer}{print(1)
+print(2)}
+
+end"""
+
+    def test_fanout(self):
+        html, text, ast = fanout(self.source, [HTML(), Text(), AST()], home='/index.html')
+        self.assertEqual(html, render(self.source, dict(home='/index.html')))
+        expected = """Héllo
+=====
+
+Some text with code and a link </index.html> over lines.
+
+Part
+
+- one
+- two
+
+print(1)
+print(2)
+
+end
+
+"""
+        self.assertEqual(text['body'], expected)
+        self.assertEqual(text['title'], 'Héllo')
+        self.assertEqual(loads(ast['body']), loads(dumps(list(parse(self.source)))))
+
+    def test_ast(self):
+        output = AST()(parse(self.source), dict(name='azf'), None)
+        self.assertEqual(output['name'], 'azf')
+        self.assertEqual(loads(output['body']), loads(dumps(list(parse(self.source)))))
+
+    def test_limits(self):
+
+        class Small(HTML):
+
+            max_source_size = 100
+            max_nesting = 2
+
+        for renderers in ([Small(), Text()], [Text(), Small()], [AST(), Small()]):
+            with self.assertRaises(AzoufzoufException):
+                fanout(self.source, renderers)
+            with self.assertRaises(AzoufzoufException):
+                fanout('ⵣcode{ⵣcode{ⵣcode{a}}}', renderers)
+        self.assertEqual(len(fanout('ⵣcode{ⵣcode{a}}', [AST(), Small()])), 2)
+
+    def test_parse_once(self):
+
+        class Spy(AST):
+
+            def _dump(self, source):
+                self.tokens = list(source)
+                yield ''
+
+        first, second = Spy(), Spy()
+        fanout(self.source, [first, HTML(), second])
+        self.assertEqual(len(first.tokens), len(list(parse(self.source))))
+        self.assertTrue(all(a is b for a, b in zip(first.tokens, second.tokens)))
+
+
 class TestJinja(TestCase):
 
     def test_render_jinja(self):
@@ -561,3 +781,712 @@ class TestJinja(TestCase):
         output = jinja(template, dict(name="Azoufazouf", status="tested"), path, capitalize=capitalize)
         self.assertEqual(output, 'Héllo Azoufazouf, you are TESTED! Bye!')
         rmtree(path)
+
+    def test_stream_jinja(self):
+        path = mkdtemp()
+        template = 'page.jinja'
+        with open(os.path.join(path, template), 'w') as f:
+            f.write("<html>{% for chunk in body %}{{ chunk }}{% endfor %}</html>")
+        destination = os.path.join(path, 'page.html')
+        context = HTML.stream("Héllo\n\nⵣsection{Azoufzouf}\n")
+        Jinja.stream(template, destination, path, **context)
+        with open(destination) as f:
+            output = f.read()
+        self.assertEqual(output, '<html><p>Héllo</p><h2>Azoufzouf</h2></html>')
+        rmtree(path)
+
+
+class TestRenderMany(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        with open(os.path.join(self.path, 'code.py'), 'w') as f:
+            f.write('print("héllo")')
+        self.sources = list()
+        for index in range(20):
+            source = 'ⵣtitle{Page %s}\n\nⵣinclude{code.py}\n' % index
+            if index % 2:
+                filepath = os.path.join(self.path, '%s.azf' % index)
+                with open(filepath, 'w') as f:
+                    f.write(source)
+                source = Path(filepath)
+            self.sources.append(source)
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def expected(self, index):
+        source = 'ⵣtitle{Page %s}\n\nⵣinclude{code.py}\n' % index
+        return render(source, dict(site='azf'), self.path)
+
+    def test_render_many(self):
+        outputs = HTML.render_many(self.sources, context=dict(site='azf'), basepath=self.path)
+        for index, (source, output) in enumerate(outputs):
+            self.assertIs(source, self.sources[index])
+            self.assertEqual(output, self.expected(index))
+
+    def test_render_many_template(self):
+        with open(os.path.join(self.path, 'page.jinja'), 'w') as f:
+            f.write('{{ site }}: {{ title }}')
+        outputs = HTML.render_many(
+            self.sources,
+            template='page.jinja',
+            context=dict(site='azf'),
+            basepath=self.path,
+            paths=(self.path,),
+        )
+        outputs = [output for _, output in outputs]
+        self.assertEqual(outputs, ['azf: Page %s' % index for index in range(20)])
+
+    def test_render_many_workers(self):
+        outputs = HTML.render_many(self.sources, basepath=self.path, workers=4)
+        self.assertEqual([source for source, _ in outputs], self.sources)
+        outputs = HTML.render_many(self.sources, basepath=self.path, workers=4, ordered=False)
+        outputs = {str(source): output for source, output in outputs}
+        self.assertEqual(len(outputs), 20)
+        for index, source in enumerate(self.sources):
+            self.assertEqual(outputs[str(source)]['body'], self.expected(index)['body'])
+
+
+class Counting(HTML):
+
+    def count(self):
+        self._cache['count'] = self._cache.get('count', 0) + 1
+        yield ''
+
+
+class TestRequireMemo(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.write('nav.azf', 'ⵣcount ⵣcontext{site} ⵣinclude{footer.txt}')
+        self.write('footer.txt', 'bye')
+        self.renderer = Counting()
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def write(self, filename, content):
+        with open(os.path.join(self.path, filename), 'w') as f:
+            f.write(content)
+
+    def render(self, **context):
+        source = 'ⵣtitle{%s}\n\nⵣrequire{nav.azf}' % context.get('title')
+        return self.renderer(parse(source), context, self.path)['body']
+
+    def test_memoized(self):
+        outputs = [self.render(site='azf', title=index) for index in range(10)]
+        self.assertEqual(self.renderer._cache['count'], 1)
+        expected = Counting.render('ⵣtitle{3}\n\nⵣrequire{nav.azf}', self.path, site='azf')['body']
+        self.assertEqual(outputs[3], expected)
+
+    def test_context_read(self):
+        self.render(site='azf')
+        self.render(site='azoufzouf')
+        self.render(site='azf')
+        self.assertEqual(self.renderer._cache['count'], 2)
+
+    def test_files_changed(self):
+        self.render(site='azf')
+        self.write('footer.txt', 'see you')
+        self.assertIn('see you', self.render(site='azf'))
+        self.write('nav.azf', 'ⵣcount ⵣcontext{site}!')
+        self.assertIn('azf!', self.render(site='azf'))
+        self.assertEqual(self.renderer._cache['count'], 3)
+
+    def test_shared_by_classes(self):
+        self.write('part.azf', 'ⵣsection{Hi}')
+        cache = Cache()
+        source = list(parse('ⵣrequire{part.azf}'))
+        self.assertIn('<h2>Hi</h2>', HTML(cache)(source, dict(), self.path)['body'])
+        self.assertEqual(Text(cache)(source, dict(), self.path)['body'], Text.render('ⵣrequire{part.azf}', self.path)['body'])
+
+    def test_references(self):
+        self.write('part.azf', 'ⵣcount ⵣhref{home}{home}')
+        source = list(parse('ⵣrequire{part.azf}'))
+        self.renderer.references = dict(home='/old.html')
+        self.assertIn('/old.html', self.renderer(source, dict(), self.path)['body'])
+        self.renderer.references = dict(home='/new.html', other='/other.html')
+        self.assertIn('/new.html', self.renderer(source, dict(), self.path)['body'])
+        self.renderer.references = dict(home='/new.html')
+        self.assertIn('/new.html', self.renderer(source, dict(), self.path)['body'])
+        self.assertEqual(self.renderer._cache['count'], 2)
+
+    def test_memo_is_bounded(self):
+        self.write('nav.azf', 'ⵣcount ⵣcontext{title}')
+        start = perf_counter()
+        for index in range(2000):
+            self.assertIn('>%s<' % index, self.render(title=index))
+        self.assertLess(perf_counter() - start, 10)
+        memo = [value for key, value in self.renderer._cache._items.items() if key[0] == 'require']
+        self.assertEqual(len(memo), 1)
+        self.assertEqual(len(memo[0]), Counting.require_memo_size)
+        self.render(title=1999)
+        self.assertEqual(self.renderer._cache['count'], 2000)
+
+    def test_nested(self):
+        self.write('page.azf', 'ⵣrequire{nav.azf}')
+        for site in ('azf', 'azoufzouf', 'azf', 'azoufzouf'):
+            output = self.renderer(parse('ⵣrequire{page.azf}'), dict(site=site), self.path)['body']
+            self.assertIn(site, output)
+        self.assertEqual(self.renderer._cache['count'], 2)
+
+
+# worker processes unpickle the renderer, so these classes are module level
+class ParallelHTML(HTML):
+
+    workers = 2
+    chunk_size = 3
+
+
+class SmallChunks(HTML):
+
+    workers = 2
+    chunk_size = 2
+
+
+class LimitedParallel(ParallelHTML):
+
+    max_output_size = 30
+
+
+class Defining(SmallChunks):
+
+    def define(self, name, value):
+        with self._inline():
+            name, value = (''.join(self.to_html(argument)) for argument in (name, value))
+        self._context[name] = value
+        yield from ()
+
+
+class TestParallel(TestCase):
+
+    def test_chunks(self):
+        tokens = list(parse('a\n\nb\nc\n\n\nd ⵣcode{e}\n\nf'))
+        chunks = list(ParallelHTML()._chunks(tokens))
+        self.assertEqual(sum(chunks, []), tokens)
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 6, 4, 1])
+
+    def test_same_output(self):
+        path = mkdtemp()
+        with open(os.path.join(path, 'part.azf'), 'w') as f:
+            f.write('ⵣsection{Part}\n\nrequired')
+        source = """
+
+ⵣtitle{Parallel}
+paragraph one
+over two lines
+
+
+ⵣlist{ⵣitem{one}
+
+ⵣitem{two}}
+text ⵣsection{inline section} text
+
+ⵣrequire{part.azf}
+
+ⵣhighlight{python}{print(1)
+
+
+print(2)}
+
+"""
+        source = source * 30
+        output = ParallelHTML.render(source, path, site='azf')
+        self.assertEqual(output, render(source, dict(site='azf'), path))
+        self.assertEqual(output['title'], 'Parallel')
+        rmtree(path)
+
+    def test_context_across_chunks(self):
+        source = 'ⵣtitle{X}\n\npara\n\n' * 3 + 'ⵣcontext{title}\n\nend'
+        output = SmallChunks.render(source)
+        self.assertEqual(output, render(source))
+        self.assertIn('<p>X</p>', output['body'])
+
+    def test_commands_setting_context(self):
+        source = 'ⵣcontext{name}\n\npara\n\n' * 3 + 'ⵣdefine{name}{Y}\n\n' + 'ⵣcontext{name}\n\npara\n\n' * 3
+
+        class Serial(Defining):
+
+            workers = None
+
+        output = Defining.render(source, name='X')
+        self.assertEqual(output, Serial.render(source, name='X'))
+        self.assertEqual(output['body'].count('<p>Y</p>'), 3)
+
+    def test_limits(self):
+        with self.assertRaises(AzoufzoufException):
+            LimitedParallel.render('paragraph\n\n' * 20)
+
+
+class TestThreads(TestCase):
+
+    def test_shared_renderer(self):
+        path = mkdtemp()
+        with open(os.path.join(path, 'code.js'), 'w') as f:
+            f.write('function troll() { return undefined;}')
+        with open(os.path.join(path, 'part.azf'), 'w') as f:
+            f.write('ⵣsection{ⵣcontext{name}}\n\nⵣinclude{code.js}')
+        sources = list()
+        for index in range(200):
+            source = 'ⵣtitle{Page %s}\n\nⵣlist{ⵣitem{ⵣcode{%s}}}\n\n' % (index, index)
+            source += 'ⵣrequire{part.azf}\n\nⵣhighlight{python}{print(%s)}\n' % index
+            sources.append(source)
+        expected = [render(source, dict(name='azf'), path) for source in sources]
+
+        renderer = HTML()
+
+        def one(source):
+            return renderer(parse(source), dict(name='azf'), path)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for _ in range(3):
+                with ThreadPoolExecutor(8) as executor:
+                    outputs = list(executor.map(one, sources))
+                self.assertEqual(outputs, expected)
+        finally:
+            sys.setswitchinterval(interval)
+        rmtree(path)
+
+    def test_reentrant(self):
+        renderer = HTML()
+        first = renderer.generate(parse('ⵣtitle{First}\n\nfirst'), dict(), None)
+        second = renderer.generate(parse('ⵣtitle{Second}\n\nsecond'), dict(), None)
+        first, second = iter(first['body']), iter(second['body'])
+        self.assertEqual(next(second) + next(first), '<h1>Second</h1><p>second</p><h1>First</h1><p>first</p>')
+
+
+class TestCache(TestCase):
+
+    def test_least_recently_used(self):
+        cache = Cache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.setdefault('a', 4), 1)
+        self.assertEqual(cache.setdefault('d', 4), 4)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('c'), None)
+
+    def test_renderer_cache_is_bounded(self):
+        renderer = HTML(Cache(10))
+        for index in range(50):
+            renderer(parse('ⵣhighlight{python}{print(%s)}' % index), dict(), None)
+        self.assertEqual(len(renderer._cache), 10)
+
+    def test_shared_by_classes(self):
+        cache = Cache()
+        source = list(parse('ⵣhighlight{python}{print(1)}'))
+        html = HTML(cache)(source, dict(), None)['body']
+        compact = CompactHTML(cache)(source, dict(), None)['body']
+        self.assertEqual(compact, CompactHTML.render('ⵣhighlight{python}{print(1)}')['body'])
+        self.assertNotEqual(html, compact)
+
+
+class Limited(HTML):
+
+    max_source_size = 1000
+    max_nesting = 10
+    max_require_depth = 3
+    max_output_size = 200
+    time_budget = 1
+    confine_paths = True
+
+
+class TestLimits(TestCase):
+
+    def test_source_size(self):
+        with self.assertRaises(AzoufzoufException):
+            Limited.render('a' * 1001)
+
+    def test_nesting(self):
+        with self.assertRaises(AzoufzoufException):
+            list(parse('ⵣa{' * 11, max_nesting=10))
+        with self.assertRaises(AzoufzoufException):
+            Limited.render('ⵣcode{' * 11)
+        output = Limited.render('ⵣcode{' * 10)['body']
+        self.assertEqual(output, '<p>' + '<code>' * 10 + '</code>' * 10 + '</p>')
+
+    def test_output_size(self):
+        with self.assertRaises(AzoufzoufException):
+            Limited.render('ⵣsection{a}\n' * 30)
+
+    def test_file_size(self):
+        path = mkdtemp()
+        with open(os.path.join(path, 'big.txt'), 'w') as f:
+            f.write('a' * 1001)
+        with self.assertRaises(AzoufzoufException):
+            Limited.render('ⵣinclude{big.txt}', path)
+        with self.assertRaises(AzoufzoufException):
+            Limited.render('ⵣrequire{big.txt}', path)
+        rmtree(path)
+
+        class Devices(Limited):
+
+            confine_paths = False
+
+        with self.assertRaises(AzoufzoufException):
+            Devices.render('ⵣinclude{/dev/zero}', path)
+
+    def test_confine_paths(self):
+        path = mkdtemp()
+        os.mkdir(os.path.join(path, 'doc'))
+        with open(os.path.join(path, 'secret.txt'), 'w') as f:
+            f.write('secret')
+        with open(os.path.join(path, 'doc', 'part.azf'), 'w') as f:
+            f.write('ⵣinclude{../secret.txt}')
+        base = os.path.join(path, 'doc')
+        for source in ('ⵣinclude{/etc/hostname}', 'ⵣinclude{../secret.txt}', 'ⵣrequire{part.azf}'):
+            with self.assertRaises(AzoufzoufException):
+                Limited.render(source, base)
+        self.assertIn('secret', render('ⵣrequire{part.azf}', basepath=base)['body'])
+        self.assertIn('secret', Limited.render('ⵣrequire{doc/part.azf}', path)['body'])
+        rmtree(path)
+
+    def test_recursion(self):
+
+        class Deep(HTML):
+
+            max_nesting = sys.getrecursionlimit()
+
+        with self.assertRaises(AzoufzoufException):
+            Deep.render('ⵣcode{' * (sys.getrecursionlimit() - 1))
+
+    def test_time_budget(self):
+
+        class Slow(HTML):
+
+            time_budget = 0.01
+
+            def slow(self):
+                yield from ()
+                from time import sleep
+                sleep(0.02)
+
+        with self.assertRaises(AzoufzoufException):
+            Slow.render('ⵣslow ⵣslow')
+
+    def test_require_cycle(self):
+        path = mkdtemp()
+        with open(os.path.join(path, 'a.azf'), 'w') as f:
+            f.write('ⵣrequire{b.azf}')
+        with open(os.path.join(path, 'b.azf'), 'w') as f:
+            f.write('ⵣrequire{a.azf}')
+        with self.assertRaises(AzoufzoufException):
+            render('ⵣrequire{a.azf}', basepath=path)
+        rmtree(path)
+
+    def test_require_depth(self):
+        path = mkdtemp()
+        for index in range(4):
+            with open(os.path.join(path, '%s.azf' % index), 'w') as f:
+                f.write('ⵣrequire{%s.azf}' % (index + 1))
+        with open(os.path.join(path, '4.azf'), 'w') as f:
+            f.write('end')
+        self.assertEqual(render('ⵣrequire{0.azf}', basepath=path)['body'], '<p>end</p>')
+        with self.assertRaises(AzoufzoufException):
+            Limited.render('ⵣrequire{0.azf}', path)
+        rmtree(path)
+
+
+class TestComplexity(TestCase):
+
+    def duration(self, source):
+        timings = list()
+        for _ in range(3):
+            start = perf_counter()
+            list(parse(source))
+            timings.append(perf_counter() - start)
+        return min(timings)
+
+    def assertLinear(self, make):
+        # 8 times more input, linear takes ~8 times longer, quadratic ~64
+        small = self.duration(make(2000))
+        big = self.duration(make(16000))
+        self.assertLess(big / small, 24)
+
+    def test_unclosed_arguments(self):
+        self.assertLinear(lambda n: 'ⵣa{' * n)
+
+    def test_nested_arguments(self):
+        self.assertLinear(lambda n: 'ⵣa{' * n + '}' * n)
+
+    def test_unclosed_braces(self):
+        self.assertLinear(lambda n: 'ⵣa{' + '{' * n)
+
+    def test_nested_braces(self):
+        self.assertLinear(lambda n: 'ⵣa{' * (n // 2) + 'x{' * (n // 2))
+
+    def test_commands(self):
+        self.assertLinear(lambda n: 'ⵣa' * n)
+
+
+class TestStream(TestCase):
+
+    def test_body_is_lazy(self):
+        output = HTML.stream("ⵣtitle{Héllo}\n\nⵣunknown")
+        self.assertIsInstance(output['body'], Body)
+        self.assertNotIn('title', output)
+        with self.assertRaises(AzoufzoufException):
+            str(output['body'])
+        self.assertEqual(output['title'], 'Héllo')
+
+    def test_body_chunks(self):
+        output = HTML.stream('aaaa\n\n' * 10)
+        chunks = list(Body(iter(output['body']), size=16))
+        self.assertTrue(all(len(chunk) >= 16 for chunk in chunks[:-1]))
+        self.assertEqual(''.join(chunks), '<p>aaaa</p>' * 10)
+
+
+class TestBuild(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        self.output = os.path.join(self.path, 'output')
+        os.makedirs(os.path.join(self.source, 'notes'))
+        with open(os.path.join(self.source, 'index.azf'), 'w') as f:
+            f.write('ⵣtitle{Index}\n\nHéllo!')
+        with open(os.path.join(self.source, 'notes', 'big.azf'), 'w') as f:
+            f.write('ⵣsection{Big}\n\n' + 'paragraph\n\n' * 2000)
+        with open(os.path.join(self.path, 'page.jinja'), 'w') as f:
+            f.write('<title>{{ title }}</title>{{ body }}')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def read(self, *path):
+        with open(os.path.join(self.output, *path)) as f:
+            return f.read()
+
+    def test_build(self):
+        report = Build(self.source, self.output, 'page.jinja', (self.path,))()
+        self.assertIsNone(report)
+        self.assertEqual(self.read('index.html'), '<title>Index</title><h1>Index</h1><p>Héllo!</p>')
+        self.assertTrue(self.read('notes', 'big.html').startswith('<title></title><h2>Big</h2>'))
+
+    def test_stylesheet(self):
+        with open(os.path.join(self.path, 'page.jinja'), 'w') as f:
+            f.write('<link href="{{ stylesheet }}">{{ body }}')
+        for _ in range(2):
+            build = Build(self.source, self.output, 'page.jinja', (self.path,), renderer=CompactHTML, baseurl='/site/')
+            build()
+        self.assertEqual(self.read('highlight.css'), CompactHTML.stylesheet())
+        self.assertTrue(self.read('index.html').startswith('<link href="/site/highlight.css">'))
+        self.assertIn('highlight.css', build.sink.manifest)
+        self.assertEqual((build.sink.written, build.sink.skipped), (0, 3))
+        Build(self.source, os.path.join(self.path, 'plain'))()
+        self.assertNotIn('highlight.css', os.listdir(os.path.join(self.path, 'plain')))
+
+    def test_references(self):
+        with open(os.path.join(self.source, 'notes', 'links.azf'), 'w') as f:
+            f.write('ⵣhref{notes/big}{big} ⵣhref{notes/links#here}{here} ⵣanchor{here}')
+        Build(self.source, self.output, baseurl='/site/')()
+        expected = '<p><a href="/site/notes/big.html">big</a> '
+        expected += '<a href="/site/notes/links.html#here">here</a> <a id="here"></a></p>'
+        self.assertEqual(self.read('notes', 'links.html'), expected)
+
+    def test_references_after_baseurl_change(self):
+        with open(os.path.join(self.source, 'notes', 'links.azf'), 'w') as f:
+            f.write('ⵣhref{notes/big}{big}')
+        Build(self.source, self.output, baseurl='/old/')()
+        Build(self.source, self.output, baseurl='/new/')()
+        self.assertEqual(self.read('notes', 'links.html'), '<p><a href="/new/notes/big.html">big</a></p>')
+
+    def test_references_do_not_override_context(self):
+        with open(os.path.join(self.source, 'site.azf'), 'w') as f:
+            f.write('ⵣcontext{site} ⵣhref{site}{site}')
+        with open(os.path.join(self.path, 'index.jinja'), 'w') as f:
+            f.write('{{ index["index.azf"].title }} {{ body }}')
+        Build(self.source, self.output, 'index.jinja', (self.path,), context=dict(site='azf'))()
+        expected = 'Index <p>azf <a href="azf">site</a></p>'
+        self.assertEqual(self.read('site.html'), expected)
+        with open(os.path.join(self.source, 'site.azf'), 'w') as f:
+            f.write('ⵣhref{site}{site}')
+        Build(self.source, self.output, 'index.jinja', (self.path,))()
+        self.assertEqual(self.read('site.html'), 'Index <p><a href="/site.html">site</a></p>')
+
+    def test_index(self):
+        build = Build(self.source, self.output)
+        build()
+        index = Index.load(build.index_path())
+        self.assertEqual(index.documents['index.azf']['title'], 'Index')
+        self.assertEqual(index.documents['index.azf']['url'], '/index.html')
+        self.assertEqual(index.documents[os.path.join('notes', 'big.azf')]['sections'], [['section', 'Big']])
+        # only changed documents are collected again
+        build = Build(self.source, self.output)
+        documents = build.documents()
+        self.assertEqual(build.index.update(self.source, documents, build.url, build._tokens), [])
+        with open(os.path.join(self.source, 'index.azf'), 'w') as f:
+            f.write('ⵣtitle{Home ⵣcode{azf}}')
+        os.remove(os.path.join(self.source, 'notes', 'big.azf'))
+        documents = build.documents()
+        self.assertEqual(build.index.update(self.source, documents, build.url, build._tokens), ['index.azf'])
+        self.assertEqual(list(build.index.documents), ['index.azf'])
+        self.assertEqual(build.index.documents['index.azf']['title'], 'Home azf')
+
+    def test_unchanged_files_are_skipped(self):
+        build = Build(self.source, self.output)
+        build()
+        self.assertEqual((build.sink.written, build.sink.skipped), (2, 0))
+        filepath = os.path.join(self.output, 'index.html')
+        os.utime(filepath, (0, 0))
+        with open(os.path.join(self.source, 'notes', 'big.azf'), 'w') as f:
+            f.write('ⵣsection{Small}')
+        build = Build(self.source, self.output)
+        build()
+        self.assertEqual((build.sink.written, build.sink.skipped), (1, 1))
+        self.assertEqual(os.stat(filepath).st_mtime, 0)
+        self.assertEqual(self.read('notes', 'big.html'), '<h2>Small</h2>')
+        # a file removed from the output is written again
+        os.remove(filepath)
+        build = Build(self.source, self.output)
+        build()
+        self.assertEqual((build.sink.written, build.sink.skipped), (1, 1))
+        self.assertEqual(self.read('index.html'), '<h1>Index</h1><p>Héllo!</p>')
+
+    def test_sink_stream(self):
+        sink = Sink(self.output)
+        self.assertTrue(sink.write('page.html', iter(['Hé', 'llo'])))
+        self.assertFalse(sink.write('page.html', 'Héllo'))
+        self.assertFalse(sink.write('page.html', iter(['Héllo'])))
+        self.assertTrue(sink.write('page.html', iter(['Bye'])))
+        self.assertEqual((sink.written, sink.skipped), (2, 2))
+        self.assertEqual(os.listdir(self.output), ['page.html'])
+        sink.save()
+        self.assertEqual(Sink(self.output).manifest, sink.manifest)
+
+    def test_report(self):
+        report = Build(self.source, self.output, profile=True)()
+        names = [document['name'] for document in report.slowest(1)]
+        self.assertEqual(names, [os.path.join('notes', 'big.azf')])
+        self.assertEqual(report.heaviest(), [])
+        self.assertIn('slowest documents:', report.format())
+        filepath = os.path.join(self.path, 'report.json')
+        report.dump(filepath)
+        with open(filepath) as f:
+            documents = load(f)['documents']
+        self.assertEqual([document['name'] for document in documents], ['index.azf', os.path.join('notes', 'big.azf')])
+        self.assertEqual(set(documents[0]), {'name', 'wall', 'cpu'})
+
+    def test_report_memory(self):
+        report = Build(self.source, self.output, profile=True, memory=True)()
+        names = [document['name'] for document in report.heaviest(1)]
+        self.assertEqual(names, [os.path.join('notes', 'big.azf')])
+        self.assertEqual(report.slowest(), [])
+        self.assertIn('heaviest documents:', report.format())
+        self.assertEqual(set(report.documents[0]), {'name', 'memory'})
+
+    def test_command_line(self):
+        filepath = os.path.join(self.path, 'report.json')
+        azf = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'azf.py')
+        output = subprocess.check_output([
+            sys.executable, azf, 'build', self.source, self.output,
+            '--profile', '--top=1', '--report=%s' % filepath
+        ])
+        self.assertIn('notes/big.azf', output.decode('utf-8'))
+        self.assertTrue(os.path.exists(filepath))
+        output = subprocess.check_output([sys.executable, azf, 'build', self.source, self.output, '--memory'])
+        self.assertIn('heaviest documents:', output.decode('utf-8'))
+        self.assertEqual(self.read('index.html'), '<h1>Index</h1><p>Héllo!</p>')
+
+
+class TestShards(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        os.makedirs(os.path.join(self.source, 'parts'))
+        for index in range(20):
+            with open(os.path.join(self.source, 'page%s.azf' % index), 'w') as f:
+                f.write('ⵣtitle{Page %s}\n\nⵣhref{page%s}{next}' % (index, (index + 1) % 20))
+                if index % 5 == 0:
+                    f.write('\n\nⵣrequire{parts/part%s.azf}' % (index // 5))
+        for index in range(4):
+            with open(os.path.join(self.source, 'parts', 'part%s.azf' % index), 'w') as f:
+                f.write('ⵣsection{Part %s}' % index)
+        # page1 and page5 now share a group through parts/part1.azf
+        with open(os.path.join(self.source, 'page1.azf'), 'a') as f:
+            f.write('\n\nⵣrequire{parts/part1.azf}')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def azf(self, *arguments):
+        azf = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'azf.py')
+        return subprocess.Popen([sys.executable, azf] + list(arguments), stdout=subprocess.DEVNULL)
+
+    def files(self, output):
+        out = dict()
+        for root, _, filenames in os.walk(output):
+            for filename in filenames:
+                if filename.endswith('.html'):
+                    with open(os.path.join(root, filename)) as f:
+                        out[os.path.relpath(os.path.join(root, filename), output)] = f.read()
+        return out
+
+    def load(self, output, filename):
+        with open(os.path.join(output, filename)) as f:
+            return load(f)
+
+    def test_shards(self):
+        expected = os.path.join(self.path, 'expected')
+        Build(self.source, expected)()
+
+        output = os.path.join(self.path, 'output')
+        shards = [self.azf('build', self.source, output, '--shard=%s/3' % index) for index in (1, 2, 3)]
+        self.assertEqual([shard.wait() for shard in shards], [0, 0, 0])
+        self.assertEqual(self.azf('merge', output, '--shards=3').wait(), 0)
+
+        self.assertEqual(self.files(output), self.files(expected))
+        manifest = self.load(output, '.azf-manifest.json')
+        self.assertEqual(manifest, self.load(expected, '.azf-manifest.json'))
+        self.assertEqual(self.load(output, '.azf-index.json'), self.load(expected, '.azf-index.json'))
+
+        # every page is built by one shard, with the pages it shares requires with
+        shards = [self.load(output, '.azf-manifest.%s-3.json' % index) for index in (1, 2, 3)]
+        self.assertEqual(sum(len(shard) for shard in shards), len(manifest))
+        self.assertTrue(all(shards))
+        for group in (('page0', 'parts/part0'), ('page1', 'page5', 'parts/part1')):
+            owners = [index for index, shard in enumerate(shards) if group[0] + '.html' in shard]
+            self.assertEqual(len(owners), 1)
+            for name in group:
+                self.assertIn(name + '.html', shards[owners[0]])
+
+    def test_merge_other_count(self):
+        output = os.path.join(self.path, 'output')
+        for index in (1, 2, 3, 4):
+            Build(self.source, output, shard=(index, 4))()
+        os.remove(os.path.join(self.source, 'page0.azf'))
+        for index in (1, 2):
+            Build(self.source, output, shard=(index, 2))()
+        Build.merge(output, 2)
+        index = self.load(output, '.azf-index.json')
+        self.assertNotIn('page0.azf', index['documents'])
+        self.assertIn('page1.azf', index['documents'])
+        with self.assertRaises(AzoufzoufException):
+            Build.merge(output, 5)
+
+    def test_command_line(self):
+        output = os.path.join(self.path, 'output')
+        for argument in ('--shard=a/b', '--shard=3/2'):
+            process = subprocess.run(
+                [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'azf.py'),
+                 'build', self.source, output, argument],
+                stderr=subprocess.PIPE,
+            )
+            self.assertIn(b'AzoufzoufException: --shard must be i/N', process.stderr)
+
+    def test_deterministic(self):
+        documents = list()
+        for _ in range(2):
+            shards = [Build(self.source, self.path, shard=(index, 3)) for index in (1, 2, 3)]
+            for shard in shards:
+                shard.index.update(self.source, shard.documents(), shard.url, shard._tokens)
+            documents.append([shard._sharded(shard.documents()) for shard in shards])
+        self.assertEqual(documents[0], documents[1])
+        self.assertEqual(sorted(sum(documents[0], [])), Build(self.source, self.path).documents())